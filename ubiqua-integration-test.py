@@ -1,24 +1,36 @@
-import locale
 import logging
 import os
-import threading
-from contextlib import contextmanager
-from dataclasses import dataclass, asdict
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import psycopg
 from dotenv import load_dotenv
-from psycopg.rows import dict_row
+from psycopg.rows import dict_row, tuple_row
 from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError, BulkWriteError
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
 
 logging.basicConfig(format='%(asctime)s [%(levelname)s] - %(message)s', level=logging.INFO)
 load_dotenv()
 
+# Number of documents sent per 'Collection.insert_many(...)' call
+MONGO_BATCH_SIZE = 50
+# Number of concurrent 'Collection.insert_many(...)' calls
+MONGO_MAX_WORKERS = 8
+# Checks every order document against the Order dataclass before inserting it (skipped when running with -O)
+VALIDATE_DOCUMENTS = os.getenv("VALIDATE_DOCUMENTS", "").lower() in ("1", "true")
+# Maps a client's short weekday 'promotion_day' to its 'datetime.weekday()' index, where Monday is 0
+PROMO_MAP = {"MON": 0, "TUE": 1, "WED": 2, "THU": 3, "FRI": 4, "SAT": 5, "SUN": 6}
 
-@dataclass
+
+# 'slots=True' requires Python 3.10, so '__slots__' is declared explicitly for Python 3.9
+@dataclass(frozen=True)
 class OrderItem:
+    __slots__ = ("uid", "quantity", "price", "name", "brand")
+
     uid: str
     quantity: int
     price: float
@@ -26,8 +38,11 @@ class OrderItem:
     brand: str
 
 
-@dataclass
+@dataclass(frozen=True)
 class Order:
+    __slots__ = ("uid", "date_of_order", "client_uid", "client_name", "client_address", "latitude", "longitude",
+                 "status", "subtotal", "taxes", "total", "is_promotion_day", "most_popular_brand", "order_items")
+
     uid: str
     date_of_order: datetime
     client_uid: str
@@ -41,104 +56,256 @@ class Order:
     total: float
     is_promotion_day: bool
     most_popular_brand: str
-    order_items: Tuple[OrderItem, ...]
+    order_items: List[OrderItem]
+
+
+def build_order_document(order_row: tuple,
+                         client: dict,
+                         order_items: List[dict],
+                         totals: Tuple[float, float],
+                         most_popular_brand: Optional[str]) -> dict:
+    """
+    Builds the MongoDB document of an order directly as a dictionary.
+    :param order_row: The (uid, client_uid, date_of_order, latitude, longitude, status) row of the order.
+    :param client: The client row of the order.
+    :param order_items: The order items of the order, as dictionaries.
+    :param totals: The (subtotal, taxes) pair of the order.
+    :param most_popular_brand: The brand of the order item with the highest quantity.
+    :return: The order document.
+    """
+    order_uid, client_uid, date_of_order, latitude, longitude, status = order_row
+    subtotal, taxes = totals
+
+    return {
+        "uid": order_uid,
+        "date_of_order": date_of_order,
+        "client_uid": client["uid"],
+        "client_name": client["name"],
+        "client_address": client["address"],
+        "latitude": latitude,
+        "longitude": longitude,
+        "status": status,
+        "subtotal": subtotal,
+        "taxes": taxes,
+        "total": subtotal + taxes,
+        "is_promotion_day": date_of_order.weekday() == client["_promo_idx"],
+        "most_popular_brand": most_popular_brand,
+        "order_items": order_items
+    }
+
+
+def validate_order_document(document: dict) -> Order:
+    """
+    Checks that the given order document matches the Order and OrderItem schemas.
+    :param document: The order document to check.
+    :return: The document as an Order object.
+    :raises TypeError: If the document or one of its order items has missing or unexpected fields.
+    """
+    order_items = [OrderItem(**oi) for oi in document["order_items"]]
+
+    return Order(**{**document, "order_items": order_items})
+
 
+def iter_order_documents(orders_rows: List[tuple],
+                         clients_by_uid: Dict[str, dict],
+                         items_by_order: Dict[str, List[tuple]],
+                         products_by_uid: Dict[str, tuple],
+                         totals_by_order: Dict[str, Tuple[float, float]],
+                         brands_by_order: Dict[str, str]) -> Iterator[dict]:
+    """
+    Yields one MongoDB document per order, joining the prefetched rows in memory. Order item documents are built
+    here, one order at a time, so they are never all held at once.
+    :param orders_rows: The (uid, client_uid, date_of_order, latitude, longitude, status) rows of the orders.
+    :param clients_by_uid: The client rows by client uid.
+    :param items_by_order: The (order_uid, product_uid, quantity) order item rows by order uid.
+    :param products_by_uid: The (uid, unit_price, name, brand) product rows by product uid.
+    :param totals_by_order: The (subtotal, taxes) pair by order uid.
+    :param brands_by_order: The most popular brand by order uid.
+    :return: An iterator over the order documents.
+    """
+    for order_row in orders_rows:
+        order_uid, client_uid = order_row[0], order_row[1]
+        order_items = []
+
+        for _, product_uid, quantity in items_by_order.get(order_uid, ()):
+            product_uid, unit_price, name, brand = products_by_uid[product_uid]
+            order_items.append(
+                {
+                    "uid": product_uid,
+                    "quantity": quantity,
+                    "price": unit_price,
+                    "name": name,
+                    "brand": brand
+                }
+            )
+
+        document = build_order_document(order_row,
+                                        clients_by_uid[client_uid],
+                                        order_items,
+                                        totals_by_order.get(order_uid, (0.0, 0.0)),
+                                        brands_by_order.get(order_uid)
+                                        )
 
-@contextmanager
-def setlocale(code: str):
-    with threading.Lock():
-        saved = locale.setlocale(locale.LC_ALL)
+        if __debug__ and VALIDATE_DOCUMENTS:
+            validate_order_document(document)
 
-        try:
-            yield locale.setlocale(locale.LC_ALL, code)
-        finally:
-            locale.setlocale(locale.LC_ALL, saved)
+        yield document
 
 
-def weekday_short_name(date: datetime, locale_code="en_US.UTF-8"):
+def iter_batches(documents: Iterable[dict], size: int) -> Iterator[List[dict]]:
     """
-    Returns the short name of the weekday for the given date in the given locale.
-    :param date: The date to get the weekday for.
-    :param locale_code: The locale code to use. Default: "en_US.UTF-8".
-    :return: The short name of the weekday.
+    Groups the given documents into lists of at most the given size.
+    :param documents: The documents to group.
+    :param size: The maximum number of documents per batch.
+    :return: An iterator over the batches.
     """
-    with setlocale(locale_code):
-        return date.strftime("%a").upper()
+    batch = []
+
+    for document in documents:
+        batch.append(document)
+
+        if len(batch) == size:
+            yield batch
+            # A new list is required since the yielded batch may still be in use by an insert
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def insert_orders(collection: Collection, documents: List[dict]) -> int:
+    """
+    Inserts the given order documents into the collection, ignoring documents whose 'uid' already exists.
+    :param collection: The collection to insert the documents into.
+    :param documents: The order documents to insert.
+    :return: The number of inserted documents.
+    """
+    logging.debug("documents=%s", documents)
+
+    try:
+        result = collection.insert_many(documents, ordered=False, bypass_document_validation=True)
+    except BulkWriteError as error:
+        # Gracefully ignore 'Collection.insert_many(...)' error due to duplicate keys
+        logging.debug(error.details)
+        return error.details["nInserted"]
+
+    return len(result.inserted_ids)
 
 
 if __name__ == "__main__":
     postgresql_connection_string = os.getenv("POSTGRESQL_CONNECTION_STRING", "")
     mongodb_connection_string = os.getenv("MONGODB_CONNECTION_STRING", "")
 
+    # MongoClient pools its connections internally, only one instance is created per run
+    mongo_client = MongoClient(mongodb_connection_string)
+    database = mongo_client.get_database("dcnhum24eom32t")
+    orders_collection = database.get_collection("orders")
+
+    # The unique index on 'uid' is what keeps reruns from inserting duplicates, it only needs to be created once
+    if "uid_1" not in orders_collection.index_information():
+        orders_collection.create_index("uid", unique=True)
+
+    # A single connection is enough for a one-shot run, and connect errors surface immediately with their cause
     with psycopg.connect(postgresql_connection_string) as connection:
-        with connection.cursor(name="orders_cursor", row_factory=dict_row) as cursor:
-            order_query = cursor.execute("SELECT * FROM orders")
-            orders = []
-
-            for order in order_query:
-                client = cursor.execute("SELECT * FROM clients WHERE uid = %s", [order["client_uid"]]).fetchone()
-                order_details = cursor.execute("SELECT * FROM order_items WHERE order_uid = %s",
-                                               [order["uid"]]
-                                               ).fetchall()
-                order_items = []
-                order_subtotal_without_tax = 0
-                order_tax_amount = 0
-                order_total = 0
-
-                for order_detail in order_details:
-                    product = cursor.execute("SELECT * FROM products WHERE uid = %s",
-                                             [order_detail["product_uid"]]
-                                             ).fetchone()
-                    order_subtotal_without_tax += order_detail["quantity"] * float(product["unit_price"])
-                    order_tax_amount = order_subtotal_without_tax * float(product["tax_rate"])
-                    order_total = order_subtotal_without_tax + order_tax_amount
-
-                    order_items.append(
-                        OrderItem(
-                            uid=product["uid"],
-                            quantity=order_detail["quantity"],
-                            price=float(product["unit_price"]),
-                            name=product["name"],
-                            brand=product["brand"]
-                        )
-                    )
-
-                is_promotion_day = weekday_short_name(order["date_of_order"]) == client["promotion_day"]
-                most_popular_brand = max(order_items, key=lambda oi: oi.quantity).brand
-
-                orders.append(
-                    Order(
-                        uid=order["uid"],
-                        date_of_order=order["date_of_order"],
-                        client_uid=client["uid"],
-                        client_name=client["name"],
-                        client_address=client["address"],
-                        latitude=float(order["latitude"]),
-                        longitude=float(order["longitude"]),
-                        status=order["status"],
-                        subtotal=order_subtotal_without_tax,
-                        taxes=order_tax_amount,
-                        total=order_total,
-                        is_promotion_day=is_promotion_day,
-                        most_popular_brand=most_popular_brand,
-                        order_items=tuple(order_items)
-                    )
+        # Client-side cursors: a single fetch avoids the FETCH round-trips of a server-side (named) portal.
+        # Hot reads use tuple rows and let PostgreSQL cast 'numeric' columns to 'float8' instead of Python
+        with connection.cursor(row_factory=tuple_row) as orders_cursor, \
+                connection.cursor(row_factory=dict_row) as clients_cursor, \
+                connection.cursor(row_factory=tuple_row) as details_cursor, \
+                connection.cursor(row_factory=tuple_row) as products_cursor, \
+                connection.cursor(row_factory=tuple_row) as totals_cursor, \
+                connection.cursor(row_factory=tuple_row) as brands_cursor:
+            # Prefetches every related row in bulk instead of querying per order (N+1). None of the queries depends
+            # on another's results, so they are all sent in one pipeline without waiting for each response
+            with connection.pipeline():
+                orders_cursor.execute(
+                    "SELECT uid, client_uid, date_of_order, latitude::float8, longitude::float8, status FROM orders"
+                )
+                clients_cursor.execute(
+                    """
+                    SELECT uid, name, address, promotion_day
+                    FROM clients
+                    WHERE uid IN (SELECT client_uid FROM orders)
+                    """
+                )
+                details_cursor.execute("SELECT order_uid, product_uid, quantity FROM order_items")
+                products_cursor.execute(
+                    """
+                    SELECT uid, unit_price::float8, name, brand
+                    FROM products
+                    WHERE uid IN (SELECT product_uid FROM order_items)
+                    """
+                )
+                # Subtotal and taxes are aggregated per order by PostgreSQL, taxing each line with its own product
+                # rate
+                totals_cursor.execute(
+                    """
+                    SELECT oi.order_uid,
+                           SUM(oi.quantity * p.unit_price)::float8,
+                           SUM(oi.quantity * p.unit_price * p.tax_rate)::float8
+                    FROM order_items oi
+                    JOIN products p ON p.uid = oi.product_uid
+                    GROUP BY oi.order_uid
+                    """
+                )
+                # Brand of the order item with the highest quantity in each order. Ties go to the first item in
+                # physical table order, which is the order in which the rows used to be scanned
+                brands_cursor.execute(
+                    """
+                    SELECT DISTINCT ON (oi.order_uid) oi.order_uid, p.brand
+                    FROM order_items oi
+                    JOIN products p ON p.uid = oi.product_uid
+                    ORDER BY oi.order_uid, oi.quantity DESC, oi.ctid
+                    """
                 )
 
-    client = MongoClient(mongodb_connection_string)
-    database = client.get_database("dcnhum24eom32t")
-    orders_collection = database.get_collection("orders")
-    # Transforms a list of Order objects into a list of dictionaries
-    orders_documents = list(map(lambda o: asdict(o), orders))
+            orders_rows = orders_cursor.fetchall()
+            clients_rows = clients_cursor.fetchall()
+            all_details = details_cursor.fetchall()
+            products_rows = products_cursor.fetchall()
+            totals_rows = totals_cursor.fetchall()
+            brands_rows = brands_cursor.fetchall()
 
-    logging.info({"count": len(orders_documents), "documents": orders_documents})
+        clients_by_uid = {r["uid"]: r for r in clients_rows}
 
-    try:
-        orders_collection.create_index("uid", unique=True)
-        orders_collection.insert_many(orders_documents, ordered=False)
-    except DuplicateKeyError as error:
-        # Unique index on the 'uid' field already exists
-        logging.debug(error.details)
-    except BulkWriteError as error:
-        # Gracefully ignore 'Collection.insert_many(...)' error due to duplicate keys
-        logging.debug(error.details)
+        for client in clients_rows:
+            client["_promo_idx"] = PROMO_MAP.get((client["promotion_day"] or "").upper(), -1)
+
+        products_by_uid = {r[0]: r for r in products_rows}
+        # Groups the raw order item rows by order in a single pass, their documents are only built per order while
+        # streaming so they are released batch by batch
+        items_by_order = defaultdict(list)
+
+        for order_detail in all_details:
+            items_by_order[order_detail[0]].append(order_detail)
+
+        totals_by_order = {r[0]: (r[1], r[2]) for r in totals_rows}
+        brands_by_order = dict(brands_rows)
+
+    documents = iter_order_documents(orders_rows,
+                                     clients_by_uid,
+                                     items_by_order,
+                                     products_by_uid,
+                                     totals_by_order,
+                                     brands_by_order
+                                     )
+    documents_count = 0
+    inserted_count = 0
+
+    # Inserts are bound by network I/O, so batches are sent concurrently from threads sharing the MongoClient pool.
+    # At most MONGO_MAX_WORKERS batches are in flight, so documents are built only as fast as they are inserted
+    with ThreadPoolExecutor(max_workers=MONGO_MAX_WORKERS) as executor:
+        pending = set()
+
+        for batch in iter_batches(documents, MONGO_BATCH_SIZE):
+            if len(pending) >= MONGO_MAX_WORKERS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                inserted_count += sum(f.result() for f in done)
+
+            pending.add(executor.submit(insert_orders, orders_collection, batch))
+            documents_count += len(batch)
+
+        inserted_count += sum(f.result() for f in wait(pending).done)
+
+    logging.info("count=%d", documents_count)
+    logging.info("inserted=%d", inserted_count)